@@ -1,8 +1,14 @@
 import os
 import io
+import queue
+import tempfile
+import traceback
+from typing import Optional, Union
+from concurrent.futures import Future, ThreadPoolExecutor
 import dearpygui.dearpygui as dpg
 import cairosvg
-from PIL import Image
+import numpy as np
+from PIL import Image, ImageDraw
 import chess
 
 from models.ai import AI
@@ -17,136 +23,408 @@ class ChessBoard:
     _DARK_COLOR = (118, 150, 86, 255)
     _HIGHLIGHT_COLOR = (255, 215, 0, 128)
     _MOVE_DOT_COLOR = (0, 0, 0, 180)
+    _DOT_TEX_SIZE = 32
+    _PIXEL_CACHE_SIZES = 4
     _TEX_REGISTRY = "tex_reg"
+    # chess.Piece → texture key, e.g. "wK"
+    _PIECE_KEYS = {
+        pc: ("w" if pc.color else "b") + pc.symbol().upper()
+        for pc in (chess.Piece(pt, c) for pt in chess.PIECE_TYPES for c in chess.COLORS)
+    }
+
+    def __init__(self):
+        # --- State ---
+        self._board = chess.Board()
+        self._selected_square: Optional[int] = None
+        self._piece_textures: dict[str, int] = {}
+        self._piece_items: dict[int, int] = {}
+        self._board_offset = (0.0, 0.0)
+        self._cell = float(self._SQUARE_SIZE)
+        self._pending_promotion: Optional[tuple[int, int]] = None
+        self._legal_cache: Optional[list[chess.Move]] = None
+        self._legal_set: Optional[frozenset[chess.Move]] = None
+        self._piece_style = "cooke"
+        self._ai = Models.MINIMAX_DEPTH_4
+        self._label_to_model = {str(m): m for m in Models}
+        self._ai_executor: Optional[ThreadPoolExecutor] = None
+        self._ai_results: queue.SimpleQueue = queue.SimpleQueue()
+        self._ai_thinking = False
+        self._ai_failed = False
+        self._searching_ai: Optional[AI] = None
+        self._board_px: Optional[int] = None
+        self._redraw_pending = False
+        self._piece_size = self._SQUARE_SIZE
+        self._wanted_piece_size = self._SQUARE_SIZE
+        self._tex_executor: Optional[ThreadPoolExecutor] = None
+        self._tex_results: queue.SimpleQueue = queue.SimpleQueue()
+        self._tex_job: Optional[Future] = None
+        # recently used piece sizes → pixels, so resizing back is free
+        self._pixel_cache: dict[int, dict[str, np.ndarray]] = {}
+
+    def __push(self, move: chess.Move):
+        # only the squares touched by the move need their piece redrawn
+        changed = [move.from_square, move.to_square]
+        if self._board.is_castling(move):
+            rank = chess.square_rank(move.from_square)
+            if chess.square_file(move.to_square) > chess.square_file(move.from_square):
+                changed += [chess.square(7, rank), chess.square(5, rank)]
+            else:
+                changed += [chess.square(0, rank), chess.square(3, rank)]
+        elif self._board.is_en_passant(move):
+            changed.append(
+                chess.square(
+                    chess.square_file(move.to_square),
+                    chess.square_rank(move.from_square),
+                )
+            )
 
-    # --- State ---
-    _board = chess.Board()
-    _selected_square = None
-    _piece_textures = {}
-    _pending_promotion = None
-    _piece_style = "cooke"
-    _ai = Models.MINIMAX_DEPTH_4
-    _label_to_model = {str(m): m for m in Models}
-
-    def __play_move(self, move: chess.Move):
         self._board.push(move)
-        self.__draw_board()
-        ai_move = self._ai.value.move(self._board)
-        self._board.push(ai_move)
-        self.__draw_board()
+        self._legal_cache = self._legal_set = None
+        for sq in changed:
+            self.__draw_piece(sq)
+
+    def __legal_moves(self) -> list[chess.Move]:
+        # only recomputed after a push, see __push
+        if self._legal_cache is None:
+            self._legal_cache = list(self._board.legal_moves)
+            self._legal_set = frozenset(self._legal_cache)
+        return self._legal_cache
+
+    def __is_legal(self, move: chess.Move) -> bool:
+        self.__legal_moves()
+        return move in self._legal_set
 
-    def __fen_to_symbol(self, fen_sym: str) -> str:
-        color = "w" if fen_sym.isupper() else "b"
-        return f"{color}{fen_sym.upper()}"
+    def __play_move(self, move: chess.Move):
+        self.__push(move)
+        if self._board.is_game_over():
+            return
+        self.__start_ai_search()
+
+    def __start_ai_search(self):
+        # search on a copy in the background, the result is picked up by
+        # __poll_ai_move from the render loop
+        self._ai_thinking = True
+        self._ai_failed = False
+        dpg.set_value("ai_status", "")
+        self._searching_ai = self._ai.instance
+        fut = self._ai_executor.submit(self._searching_ai.move, self._board.copy())
+        fut.add_done_callback(self._ai_results.put)
+
+    def __poll_ai_move(self):
+        try:
+            fut: Future = self._ai_results.get_nowait()
+        except queue.Empty:
+            return
+        self._ai_thinking = False
+        # a failed search (e.g. the UCI engine died) leaves the board as is,
+        # it's still the AI's turn so input stays blocked until a retry
+        exc = fut.exception()
+        if exc is not None:
+            traceback.print_exception(exc)
+            self._ai_failed = True
+            dpg.set_value("ai_status", f"AI failed: {exc!r}\nSelect a model to retry.")
+            return
+        self.__push(fut.result())
+        self.__draw_overlay()
 
     def reload_textures(self):
         dpg.delete_item(self._TEX_REGISTRY, children_only=True)
         self._piece_textures.clear()
+        self._pixel_cache.clear()
         self.__load_piece_textures()
         self.__draw_board()
 
-    def __load_piece_textures(self):
+    def __rasterize_piece(
+        self, key: str, path: str, size: int, store: bool
+    ) -> Union[str, io.BytesIO]:
+        # cairosvg is slow, so keep the rendered PNGs next to the SVGs
+        cache_dir = os.path.join("assets", self._piece_style, ".cache")
+        cache_path = os.path.join(cache_dir, f"{key}_{size}.png")
+        fresh = os.path.isfile(cache_path) and (
+            os.path.getmtime(cache_path) >= os.path.getmtime(path)
+        )
+        if fresh:
+            return cache_path
+
+        if store:
+            try:
+                # render next to the cache entry and rename it into place, so
+                # an interrupted write never leaves a truncated PNG that
+                # looks fresh
+                os.makedirs(cache_dir, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(
+                    dir=cache_dir, prefix=f"{key}_", suffix=".tmp"
+                )
+                os.close(fd)
+            except OSError:
+                pass  # read-only assets, render in memory below
+            else:
+                try:
+                    cairosvg.svg2png(
+                        url=path,
+                        write_to=tmp_path,
+                        output_width=size,
+                        output_height=size,
+                    )
+                    os.replace(tmp_path, cache_path)
+                except BaseException:
+                    os.remove(tmp_path)
+                    raise
+                return cache_path
+
+        png = cairosvg.svg2png(url=path, output_width=size, output_height=size)
+        return io.BytesIO(png)
+
+    def __piece_pixels(self, key: str, path: str, size: int, store: bool) -> np.ndarray:
+        png = self.__rasterize_piece(key, path, size, store)
+        img = Image.open(png).convert("RGBA")
+        raw = np.asarray(img, dtype=np.uint8).reshape(-1).astype(np.float32)
+        raw *= 1.0 / 255.0
+        return raw
+
+    def __render_pieces(self, size: int, store: bool = True) -> dict[str, np.ndarray]:
+        """Rasterized piece pixels by key, safe to call off the main thread.
+
+        With store=False, sizes missing from the disk cache aren't added to it.
+        """
+        jobs = []
         for sym in ("P", "N", "B", "R", "Q", "K"):
             for color in ("w", "b"):
                 key = f"{color}{sym}"
                 path = os.path.join("assets", self._piece_style, f"{key}.svg")
                 if not os.path.isfile(path):
                     raise FileNotFoundError(f"Missing SVG: {path}")
+                jobs.append((key, path))
 
-                png = cairosvg.svg2png(
-                    url=path,
-                    output_width=self._SQUARE_SIZE,
-                    output_height=self._SQUARE_SIZE,
-                )
-                img = Image.open(io.BytesIO(png)).convert("RGBA")
-                raw = [c / 255.0 for px in img.getdata() for c in px]
-
-                tex_id = dpg.add_static_texture(
-                    self._SQUARE_SIZE,
-                    self._SQUARE_SIZE,
-                    raw,
-                    parent=self._TEX_REGISTRY,
-                )
-                self._piece_textures[key] = tex_id
+        # rasterize in parallel, dpg is only touched by the caller
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            pixels = list(
+                ex.map(lambda job: self.__piece_pixels(*job, size, store), jobs)
+            )
+        return {key: raw for (key, _), raw in zip(jobs, pixels)}
+
+    def __register_piece_textures(self, size: int, pixels: dict[str, np.ndarray]):
+        textures = {}
+        for key, raw in pixels.items():
+            textures[key] = dpg.add_static_texture(
+                size,
+                size,
+                raw,
+                parent=self._TEX_REGISTRY,
+            )
+        self._piece_textures = textures
+        self._piece_size = size
+
+        self._pixel_cache.pop(size, None)
+        self._pixel_cache[size] = pixels
+        if len(self._pixel_cache) > self._PIXEL_CACHE_SIZES:
+            del self._pixel_cache[next(iter(self._pixel_cache))]
+
+    def __load_piece_textures(self):
+        size = self._piece_size
+        self.__register_piece_textures(size, self.__render_pieces(size))
+        self.__load_board_texture()
+        self.__load_dot_texture()
+
+    def __load_board_texture(self):
+        S = self._SQUARE_SIZE
+        light = np.asarray(self._LIGHT_COLOR, dtype=np.float32) / 255.0
+        dark = np.asarray(self._DARK_COLOR, dtype=np.float32) / 255.0
+        arr = np.zeros((self._BOARD_SIZE, self._BOARD_SIZE, 4), dtype=np.float32)
+        for row in range(8):
+            rank = 7 - row
+            for file in range(8):
+                color = light if (file + rank) % 2 == 0 else dark
+                arr[row * S : (row + 1) * S, file * S : (file + 1) * S] = color
+
+        dpg.add_static_texture(
+            self._BOARD_SIZE,
+            self._BOARD_SIZE,
+            arr.ravel(),
+            parent=self._TEX_REGISTRY,
+            tag="board_bg_tex",
+        )
+
+    def __load_dot_texture(self):
+        # draw oversized and downsample to get an antialiased edge
+        S = self._DOT_TEX_SIZE
+        big = Image.new("RGBA", (S * 4, S * 4), (0, 0, 0, 0))
+        ImageDraw.Draw(big).ellipse(
+            (0, 0, S * 4 - 1, S * 4 - 1), fill=self._MOVE_DOT_COLOR
+        )
+        img = big.resize((S, S), Image.LANCZOS)
+        raw = np.asarray(img, dtype=np.uint8).reshape(-1).astype(np.float32)
+        raw *= 1.0 / 255.0
+
+        dpg.add_static_texture(S, S, raw, parent=self._TEX_REGISTRY, tag="dot_tex")
 
     def __on_chess_window_resize(self):
         win_w, win_h = dpg.get_item_rect_size("ChessWindow")
 
         content_w = win_w - 20
         content_h = win_h - 40
-        size = min(content_w, content_h)
+        size = int(min(content_w, content_h))
+        # the handler fires continuously while dragging, even if the board
+        # size doesn't change
+        if size == self._board_px:
+            return
+        self._board_px = size
 
         dpg.configure_item(
             "board_drawlist",
-            width=int(size),
-            height=int(size),
+            width=size,
+            height=size,
         )
 
+        # coalesce bursts of resize events into one redraw per frame
+        self._redraw_pending = True
+        self.__request_piece_size(max(1, size // 8))
+
+    def __request_piece_size(self, size: int):
+        # re-rasterize the pieces at the on-screen cell size in the
+        # background, rather than having them resampled on every draw
+        if size == self._wanted_piece_size:
+            return
+        self._wanted_piece_size = size
+
+        # at most one job in flight, a running one is followed up by
+        # __poll_piece_textures once it finishes
+        if self._tex_job is not None and self._tex_job.cancel():
+            self._tex_job = None
+        if self._tex_job is None or size in self._pixel_cache:
+            self.__use_piece_size(size)
+
+    def __use_piece_size(self, size: int):
+        if size == self._piece_size:
+            return
+        if size in self._pixel_cache:
+            self.__swap_piece_textures(size, self._pixel_cache[size])
+        else:
+            self.__submit_piece_job(size)
+
+    def __submit_piece_job(self, size: int):
+        # sizes passed through while resizing aren't worth a disk cache entry,
+        # the ones actually swapped in are kept in _pixel_cache instead
+        fut = self._tex_executor.submit(self.__render_pieces, size, False)
+        fut.add_done_callback(lambda f: self._tex_results.put((size, f)))
+        self._tex_job = fut
+
+    def __poll_piece_textures(self):
+        try:
+            size, fut = self._tex_results.get_nowait()
+        except queue.Empty:
+            return
+        # cancelled jobs still report back, ignore anything but the current one
+        if fut is not self._tex_job:
+            return
+        self._tex_job = None
+
+        # the window may have been resized again while this one ran
+        if size != self._wanted_piece_size:
+            self.__use_piece_size(self._wanted_piece_size)
+            return
+
+        exc = fut.exception()
+        if exc is not None:
+            traceback.print_exception(exc)
+            return
+        self.__swap_piece_textures(size, fut.result())
+
+    def __swap_piece_textures(self, size: int, pixels: dict[str, np.ndarray]):
+        old = list(self._piece_textures.values())
+        self.__register_piece_textures(size, pixels)
         self.__draw_board()
+        for tex_id in old:
+            dpg.delete_item(tex_id)
 
-    def __draw_board(self):
-        # clear previous draw calls
-        dpg.delete_item("board_drawlist", children_only=True)
+    def __flush_redraw(self):
+        if self._redraw_pending:
+            self._redraw_pending = False
+            self.__draw_board()
 
-        full_w, full_h = dpg.get_item_rect_size("board_drawlist")
+    def __square_origin(self, sq: int) -> tuple[float, float]:
+        offset_x, offset_y = self._board_offset
+        x0 = offset_x + chess.square_file(sq) * self._cell
+        y0 = offset_y + (7 - chess.square_rank(sq)) * self._cell
+        return x0, y0
+
+    def __draw_piece(self, sq: int):
+        item = self._piece_items.pop(sq, None)
+        if item is not None:
+            dpg.delete_item(item)
+
+        pc = self._board.piece_at(sq)
+        if pc:
+            self.__draw_piece_image(sq, pc)
+
+    def __draw_piece_image(self, sq: int, pc: chess.Piece):
+        tex_id = self._piece_textures[self._PIECE_KEYS[pc]]
+        x0, y0 = self.__square_origin(sq)
+        self._piece_items[sq] = dpg.draw_image(
+            tex_id,
+            (x0, y0),
+            (x0 + self._cell, y0 + self._cell),
+            parent="pieces_layer",
+        )
+
+    def __draw_overlay(self):
+        # highlight selected square and show move dots
+        dpg.delete_item("overlay_layer", children_only=True)
+        if self._selected_square is None:
+            return
+
+        cell = self._cell
+        x0, y0 = self.__square_origin(self._selected_square)
+        dpg.draw_rectangle(
+            (x0, y0),
+            (x0 + cell, y0 + cell),
+            fill=self._HIGHLIGHT_COLOR,
+            parent="overlay_layer",
+        )
+        radius = cell * 0.15
+        for mv in self.__legal_moves():
+            if mv.from_square == self._selected_square:
+                x1, y1 = self.__square_origin(mv.to_square)
+                cx, cy = x1 + cell * 0.5, y1 + cell * 0.5
+                dpg.draw_image(
+                    "dot_tex",
+                    (cx - radius, cy - radius),
+                    (cx + radius, cy + radius),
+                    parent="overlay_layer",
+                )
+
+    def __draw_board(self):
+        # full repaint, only needed when the geometry or textures change
+        for layer in ("bg_layer", "overlay_layer", "pieces_layer"):
+            dpg.delete_item(layer, children_only=True)
+        self._piece_items.clear()
+
+        # the drawlist rect only catches up with a resize on the next frame,
+        # so prefer the size the resize handler configured
+        if self._board_px is not None:
+            full_w = full_h = self._board_px
+        else:
+            full_w, full_h = dpg.get_item_rect_size("board_drawlist")
         board_pixels = min(full_w, full_h)
-        cell = board_pixels / 8.0
+        self._cell = board_pixels / 8.0
 
         offset_x = (full_w - board_pixels) / 2.0
         offset_y = (full_h - board_pixels) / 2.0
+        self._board_offset = (offset_x, offset_y)
 
-        for rank in range(8):
-            for file in range(8):
-                x0 = offset_x + file * cell
-                y0 = offset_y + (7 - rank) * cell
-                x1 = x0 + cell
-                y1 = y0 + cell
-                color = (
-                    self._LIGHT_COLOR if (file + rank) % 2 == 0 else self._DARK_COLOR
-                )
-                dpg.draw_rectangle(
-                    (x0, y0), (x1, y1), fill=color, parent="board_drawlist"
-                )
+        dpg.draw_image(
+            "board_bg_tex",
+            (offset_x, offset_y),
+            (offset_x + board_pixels, offset_y + board_pixels),
+            parent="bg_layer",
+        )
 
-        # highlight selected square and show move dots
-        if self._selected_square is not None:
-            f0 = chess.square_file(self._selected_square)
-            r0 = chess.square_rank(self._selected_square)
-            x0 = offset_x + f0 * cell
-            y0 = offset_y + (7 - r0) * cell
-            dpg.draw_rectangle(
-                (x0, y0),
-                (x0 + cell, y0 + cell),
-                fill=self._HIGHLIGHT_COLOR,
-                parent="board_drawlist",
-            )
-            for mv in self._board.legal_moves:
-                if mv.from_square == self._selected_square:
-                    f1 = chess.square_file(mv.to_square)
-                    r1 = chess.square_rank(mv.to_square)
-                    cx = offset_x + f1 * cell + cell * 0.5
-                    cy = offset_y + (7 - r1) * cell + cell * 0.5
-                    dpg.draw_circle(
-                        (cx, cy),
-                        radius=cell * 0.15,
-                        fill=self._MOVE_DOT_COLOR,
-                        parent="board_drawlist",
-                    )
+        self.__draw_overlay()
 
-        # draw each piece scaled to the current cell size
-        for sq in chess.SQUARES:
-            pc = self._board.piece_at(sq)
-            if not pc:
-                continue
-            key = self.__fen_to_symbol(pc.symbol())
-            tex_id = self._piece_textures[key]
-            f = chess.square_file(sq)
-            r = chess.square_rank(sq)
-            x0 = offset_x + f * cell
-            y0 = offset_y + (7 - r) * cell
-            dpg.draw_image(
-                tex_id, (x0, y0), (x0 + cell, y0 + cell), parent="board_drawlist"
-            )
+        # draw each piece scaled to the current cell size, only the occupied
+        # squares need visiting since the layer was just cleared
+        for sq, pc in self._board.piece_map().items():
+            self.__draw_piece_image(sq, pc)
 
     def __on_promote(self, sender, app_data, user_data):
         promo_piece = user_data
@@ -155,11 +433,15 @@ class ChessBoard:
         self._pending_promotion = None
         dpg.hide_item("PromotionPopup")
         self._selected_square = None
-        if mv in self._board.legal_moves:
+        if self.__is_legal(mv):
             self.__play_move(mv)
-            self.__play_move(self._ai.value.move(self._board))
+        self.__draw_overlay()
 
     def __on_click(self, sender):
+        # ignore input while it's the AI's turn
+        if self._ai_thinking or self._ai_failed:
+            return
+
         minx, miny = dpg.get_item_rect_min(sender)
         sender_width, sender_height = dpg.get_item_rect_size(sender)
         mx, my = dpg.get_mouse_pos()
@@ -174,12 +456,12 @@ class ChessBoard:
         if self._selected_square is None:
             if self._board.piece_at(sq):
                 self._selected_square = sq
-            self.__draw_board()
+            self.__draw_overlay()
             return
 
         # move or promotion
         mv = chess.Move(self._selected_square, sq)
-        if mv in self._board.legal_moves:
+        if self.__is_legal(mv):
             self.__play_move(mv)
         else:
             piece = self._board.piece_at(self._selected_square)
@@ -191,14 +473,22 @@ class ChessBoard:
             else:
                 self._selected_square = None
 
-        self.__draw_board()
+        self.__draw_overlay()
 
     def __change_model(self, sender, model: Models):
         self._ai = self._label_to_model[model]
+        if self._ai_failed:
+            self.__start_ai_search()
 
     def start_gui(self):
         dpg.create_context()
-        dpg.configure_app(docking=True, docking_space=True)
+        # run callbacks from the render loop below, so that they never race
+        # with the AI move being applied
+        dpg.configure_app(
+            docking=True, docking_space=True, manual_callback_management=True
+        )
+        self._ai_executor = ThreadPoolExecutor(max_workers=1)
+        self._tex_executor = ThreadPoolExecutor(max_workers=1)
 
         # create one texture registry up front
         with dpg.texture_registry(tag=self._TEX_REGISTRY, show=False):
@@ -212,6 +502,9 @@ class ChessBoard:
                 tag="board_drawlist",
                 callback=self.__on_click,
             )
+            # drawn bottom to top: squares, selection overlay, pieces
+            for layer in ("bg_layer", "overlay_layer", "pieces_layer"):
+                dpg.add_draw_layer(tag=layer, parent="board_drawlist")
 
             handler_reg = dpg.add_item_handler_registry()
             dpg.add_item_resize_handler(
@@ -248,6 +541,7 @@ class ChessBoard:
             dpg.add_combo(
                 items=list(Models), callback=self.__change_model, default_value=self._ai
             )
+            dpg.add_text("", tag="ai_status", color=(255, 80, 80))
 
         dpg.load_init_file("app_layout.ini")
         dpg.create_viewport(
@@ -256,5 +550,19 @@ class ChessBoard:
 
         dpg.setup_dearpygui()
         dpg.show_viewport()
-        dpg.start_dearpygui()
-        dpg.destroy_context()
+        try:
+            while dpg.is_dearpygui_running():
+                dpg.run_callbacks(dpg.get_callback_queue())
+                self.__poll_piece_textures()
+                self.__poll_ai_move()
+                dpg.render_dearpygui_frame()
+                # after the frame, so a resize has been applied to the drawlist
+                self.__flush_redraw()
+        finally:
+            dpg.destroy_context()
+            # don't sit out a deep search that nobody will see the end of
+            if self._ai_thinking:
+                self._searching_ai.stop()
+            self._ai_executor.shutdown(cancel_futures=True)
+            self._tex_executor.shutdown(cancel_futures=True)
+            Models.close_all()
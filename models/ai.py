@@ -8,3 +8,13 @@ class AI(ABC):
         """
         Given a chess.Board, return the "best" move.
         """
+
+    def close(self):
+        """
+        Release any resources (e.g. engine processes) held by the AI.
+        """
+
+    def stop(self):
+        """
+        Ask a search running in another thread to give up as soon as possible.
+        """
@@ -1,8 +1,19 @@
+from operator import itemgetter
 from typing import Optional, Tuple
-import chess, math
+import chess, chess.polyglot, math
 
 from models.ai import AI
 
+# transposition table bound flags
+TT_EXACT, TT_LOWER, TT_UPPER = 0, -1, +1
+
+# number of slots per transposition table tier, must be a power of two
+TT_SIZE = 2**20
+TT_MASK = TT_SIZE - 1
+
+# depth reduction applied to the null-move search
+NULL_MOVE_R = 2
+
 PIECE_VALUES = {
     chess.PAWN: 5,
     chess.KNIGHT: 30,
@@ -11,151 +22,306 @@ PIECE_VALUES = {
     chess.QUEEN: 90,
 }
 
+TTEntry = Tuple[int, float, chess.Move, int, int]
+
+
+class SearchStopped(Exception):
+    """Raised out of MiniMax.move when stop() interrupts the search."""
+
 
 class MiniMax(AI):
     def __init__(self, max_depth: int = 4):
         self.max_depth = max_depth
-        # transposition table: key → (score, best_move, depth_searched, flag)
-        # flag: 0=EXACT, -1=LOWERBOUND, +1=UPPERBOUND
-        self.tt: dict[int, Tuple[float, chess.Move, int, int]] = {}
+        # transposition table: two tiers indexed by key & TT_MASK, holding
+        # (key, score, best_move, depth_searched, flag) entries
+        # score is from the side to move's point of view, flag is a TT_* bound
+        self.tt_depth: list[Optional[TTEntry]] = [None] * TT_SIZE
+        self.tt_always: list[Optional[TTEntry]] = [None] * TT_SIZE
         # killer moves per depth
         self.killers: dict[int, chess.Move] = {}
+        # fullmove number of the last searched root, see move()
+        self._last_fullmove: Optional[int] = None
+        # running material score of the searched position and the per-move
+        # deltas needed to undo it
+        self._material = 0.0
+        self._deltas: list[float] = []
+        # principal variation of the previous iteration, keyed on ply from root
+        self._pv: dict[int, chess.Move] = {}
+        self._root_ply = 0
+        # set from another thread by stop(), cleared when move() returns
+        self._stop_requested = False
 
-    def __evaluate_position(self, board: chess.Board) -> float:
+    def stop(self):
+        # picked up by the running search, or the next one if none is running
+        self._stop_requested = True
+
+    def _tt_probe(self, key: int) -> Optional[TTEntry]:
+        idx = key & TT_MASK
+        entry = self.tt_depth[idx]
+        if entry and entry[0] == key:
+            return entry
+        entry = self.tt_always[idx]
+        if entry and entry[0] == key:
+            return entry
+        return None
+
+    def _tt_store(
+        self, key: int, score: float, move: chess.Move, depth: int, flag: int
+    ):
+        """Depth-preferred slot if the new entry is at least as deep, else
+        the always-replace slot."""
+        idx = key & TT_MASK
+        entry = (key, score, move, depth, flag)
+        old = self.tt_depth[idx]
+        if old is None or old[0] == key or depth >= old[3]:
+            self.tt_depth[idx] = entry
+        else:
+            self.tt_always[idx] = entry
+
+    def _tt_clear(self):
+        self.tt_depth = [None] * TT_SIZE
+        self.tt_always = [None] * TT_SIZE
+
+    def __material(self, board: chess.Board) -> float:
+        # popcount the per-type bitboards instead of walking piece_map()
+        popcount, vals = chess.popcount, PIECE_VALUES
+        white = board.occupied_co[chess.WHITE]
+        black = board.occupied_co[chess.BLACK]
         total = 0.0
-        vals = PIECE_VALUES
-        for p in board.piece_map().values():
-            total += vals.get(p.piece_type, 0) * (1 if p.color else -1)
+        for pt, bb in (
+            (chess.PAWN, board.pawns),
+            (chess.KNIGHT, board.knights),
+            (chess.BISHOP, board.bishops),
+            (chess.ROOK, board.rooks),
+            (chess.QUEEN, board.queens),
+        ):
+            total += vals[pt] * (popcount(bb & white) - popcount(bb & black))
         return total
 
-    def _order_moves(self, board: chess.Board, depth: int) -> list[chess.Move]:
-        """Killer first, then MVV-LVA on captures, then the rest."""
+    def __evaluate_position(self, board: chess.Board) -> float:
+        # kept up to date by _do/_undo, see move()
+        return self._material
+
+    def _do(self, board: chess.Board, move: chess.Move):
+        """board.push that also updates the running material score."""
+        delta = 0
+        if move:
+            vals = PIECE_VALUES
+            captured = board.piece_type_at(move.to_square)
+            if captured:
+                delta += vals.get(captured, 0)
+            elif board.is_en_passant(move):
+                delta += vals[chess.PAWN]
+            if move.promotion:
+                delta += vals[move.promotion] - vals[chess.PAWN]
+            if not board.turn:
+                delta = -delta
+
+        self._material += delta
+        self._deltas.append(delta)
+        board.push(move)
+
+    def _undo(self, board: chess.Board):
+        board.pop()
+        self._material -= self._deltas.pop()
+
+    def _order_moves(
+        self, board: chess.Board, depth: int, pv: Optional[chess.Move] = None
+    ) -> list[chess.Move]:
+        """PV move first, then killer, then MVV-LVA on captures, then the rest."""
         km = self.killers.get(depth)
-        moves = list(board.legal_moves)
         ordered: list[chess.Move] = []
-        if km in moves:
-            ordered.append(km)
-            moves.remove(km)
-
-        # capture MVV–LVA
-        def mvv_lva(m: chess.Move) -> int:
-            if board.is_capture(m):
-                vic = board.piece_at(
-                    m.to_square
-                    if not board.is_en_passant(m)
-                    else (m.to_square + (-8 if board.turn else +8))
-                )
-                atk = board.piece_at(m.from_square)
-                v = PIECE_VALUES.get(vic.piece_type, 0) if vic else 0
-                a = PIECE_VALUES.get(atk.piece_type, 0) if atk else 0
-                return v * 100 - a
-            return -1  # so non-captures sort last
-
-        captures = [m for m in moves if board.is_capture(m)]
-        captures.sort(key=mvv_lva, reverse=True)
-        ordered += captures
+        captures: list[Tuple[int, chess.Move]] = []
+        quiets: list[chess.Move] = []
 
-        # the rest
-        ordered += [m for m in moves if not board.is_capture(m)]
-        return ordered
+        vals = PIECE_VALUES
+        is_capture, piece_type_at = board.is_capture, board.piece_type_at
+        for m in board.legal_moves:
+            if m == pv:
+                ordered.insert(0, m)
+            elif m == km:
+                ordered.append(m)
+            elif is_capture(m):
+                # capture MVV–LVA, an empty target square means en passant
+                vic = piece_type_at(m.to_square) or chess.PAWN
+                atk = piece_type_at(m.from_square)
+                captures.append((vals.get(vic, 0) * 100 - vals.get(atk, 0), m))
+            else:
+                quiets.append(m)
 
-    def __min(
-        self, board: chess.Board, depth: int, alpha: float, beta: float
-    ) -> Tuple[float, Optional[chess.Move]]:
-        key = board.fen()
-        entry = self.tt.get(key)
-        if entry and entry[2] >= depth:
-            sc, mv, _, flag = entry
-            if flag == 0 or (flag > 0 and sc <= alpha) or (flag < 0 and sc < beta):
-                return sc, mv
+        captures.sort(key=itemgetter(0), reverse=True)
+        ordered += [m for _, m in captures]
 
-        if depth == 0:
-            return self.__evaluate_position(board), None
+        # the rest
+        ordered += quiets
+        return ordered
 
-        best_score = math.inf
-        best_move: Optional[chess.Move] = None
-        alpha0 = alpha
+    def _order_captures(self, board: chess.Board) -> list[chess.Move]:
+        """Legal captures only, MVV-LVA ordered."""
+        vals = PIECE_VALUES
+        piece_type_at = board.piece_type_at
+        captures = [
+            (
+                vals.get(piece_type_at(m.to_square) or chess.PAWN, 0) * 100
+                - vals.get(piece_type_at(m.from_square), 0),
+                m,
+            )
+            for m in board.generate_legal_captures()
+        ]
+        captures.sort(key=itemgetter(0), reverse=True)
+        return [m for _, m in captures]
 
-        push, pop = board.push, board.pop
-        for move in self._order_moves(board, depth):
-            push(move)
-            score, _ = self.__max(board, depth - 1, alpha, beta)
-            pop()
+    def __qsearch(
+        self, board: chess.Board, alpha: float, beta: float, color: int
+    ) -> float:
+        """Capture-only search from the side to move's point of view."""
+        best_score = color * self.__evaluate_position(board)
+        if best_score >= beta:
+            return best_score
+        alpha = max(alpha, best_score)
 
-            if score < best_score:
-                best_score, best_move = score, move
+        push, pop = self._do, self._undo
+        for move in self._order_captures(board):
+            push(board, move)
+            score = -self.__qsearch(board, -beta, -alpha, -color)
+            pop(board)
 
-            beta = min(beta, best_score)
-            if alpha >= beta:
-                # record killer and cutoff
-                self.killers[depth] = move
-                break
+            if score > best_score:
+                best_score = score
+                alpha = max(alpha, score)
+                if alpha >= beta:
+                    break
 
-        # store in TT
-        if best_score <= alpha0:
-            flag = +1  # upperbound
-        elif best_score >= beta:
-            flag = -1  # lowerbound
-        else:
-            flag = 0  # exact
-        self.tt[key] = (best_score, best_move or chess.Move.null(), depth, flag)
+        return best_score
 
-        return best_score, best_move
+    def __can_null_move(self, board: chess.Board, depth: int, beta: float) -> bool:
+        # a null move can't fail high against an infinite beta, which is
+        # always the case at the root
+        if beta == math.inf or len(board.move_stack) == self._root_ply:
+            return False
+        # skip in check, right after another null move, and with only pawns
+        # left, where zugzwang makes the null-move assumption unsound
+        if depth < 3 or board.is_check():
+            return False
+        if board.move_stack and not board.move_stack[-1]:
+            return False
+        return bool(board.occupied_co[board.turn] & ~(board.pawns | board.kings))
 
-    def __max(
-        self, board: chess.Board, depth: int, alpha: float, beta: float
+    def __negamax(
+        self,
+        board: chess.Board,
+        depth: int,
+        alpha: float,
+        beta: float,
+        color: int,
+        on_pv: bool = False,
     ) -> Tuple[float, Optional[chess.Move]]:
-        key = board.fen()
-        entry = self.tt.get(key)
-        if entry and entry[2] >= depth:
-            sc, mv, _, flag = entry
-            if flag == 0 or (flag < 0 and sc >= beta) or (flag > 0 and sc > alpha):
-                return sc, mv
+        """Fail-soft alpha-beta, scores are from the side to move's view.
+
+        on_pv is set while following the previous iteration's PV from the root.
+        """
+        if self._stop_requested:
+            raise SearchStopped
+        key = chess.polyglot.zobrist_hash(board)
+        entry = self._tt_probe(key)
+        if entry and entry[3] >= depth:
+            _, sc, mv, _, flag = entry
+            if flag == TT_EXACT:
+                return sc, mv or None
+            elif flag == TT_LOWER:
+                alpha = max(alpha, sc)
+            elif flag == TT_UPPER:
+                beta = min(beta, sc)
+            if alpha >= beta:
+                return sc, mv or None
 
         if depth == 0:
-            return self.__evaluate_position(board), None
+            return self.__qsearch(board, alpha, beta, color), None
+
+        if self.__can_null_move(board, depth, beta):
+            self._do(board, chess.Move.null())
+            score, _ = self.__negamax(
+                board, depth - 1 - NULL_MOVE_R, -beta, -alpha, -color
+            )
+            self._undo(board)
+            if -score >= beta:
+                return -score, None
 
         best_score = -math.inf
         best_move: Optional[chess.Move] = None
-        beta0 = beta
+        alpha0 = alpha
 
-        push, pop = board.push, board.pop
-        for move in self._order_moves(board, depth):
-            push(move)
-            score, _ = self.__min(board, depth - 1, alpha, beta)
-            pop()
+        # the stored PV move only applies while still on the PV itself
+        pv_move = None
+        if on_pv:
+            pv_move = self._pv.get(len(board.move_stack) - self._root_ply)
+
+        push, pop = self._do, self._undo
+        for move in self._order_moves(board, depth, pv_move):
+            push(board, move)
+            score, _ = self.__negamax(
+                board, depth - 1, -beta, -alpha, -color, move == pv_move
+            )
+            score = -score
+            pop(board)
 
             if score > best_score:
                 best_score, best_move = score, move
 
             alpha = max(alpha, best_score)
             if alpha >= beta:
+                # record killer and cutoff
                 self.killers[depth] = move
                 break
 
         # store in TT
-        if best_score <= alpha:
-            flag = +1
-        elif best_score >= beta0:
-            flag = -1
+        if best_score <= alpha0:
+            flag = TT_UPPER
+        elif best_score >= beta:
+            flag = TT_LOWER
         else:
-            flag = 0
-        self.tt[key] = (best_score, best_move or chess.Move.null(), depth, flag)
+            flag = TT_EXACT
+        self._tt_store(key, best_score, best_move or chess.Move.null(), depth, flag)
 
         return best_score, best_move
 
+    def __collect_pv(self, board: chess.Board, depth: int):
+        """Follow the TT best moves from the root to seed the next iteration."""
+        self._pv.clear()
+        pv_board = board.copy(stack=False)
+        for ply in range(depth):
+            entry = self._tt_probe(chess.polyglot.zobrist_hash(pv_board))
+            if not entry or not entry[2] or not pv_board.is_legal(entry[2]):
+                break
+            self._pv[ply] = entry[2]
+            pv_board.push(entry[2])
+
     def move(self, board: chess.Board) -> chess.Move:
+        try:
+            return self.__search(board)
+        finally:
+            self._stop_requested = False
+
+    def __search(self, board: chess.Board) -> chess.Move:
         board_copy = board.copy()
         best_move: Optional[chess.Move] = None
+        # entries and killers from an earlier position are of little use
+        if board_copy.fullmove_number != self._last_fullmove:
+            self._tt_clear()
+            self.killers.clear()
+            self._last_fullmove = board_copy.fullmove_number
+
+        self._material = self.__material(board_copy)
+        self._deltas.clear()
+        self._pv.clear()
+        self._root_ply = len(board_copy.move_stack)
+        color = 1 if board_copy.turn == chess.WHITE else -1
 
         for d in range(1, self.max_depth + 1):
-            alpha, beta = -math.inf, math.inf
-            if board_copy.turn == chess.WHITE:
-                _, mv = self.__max(board_copy, d, alpha, beta)
-            else:
-                _, mv = self.__min(board_copy, d, alpha, beta)
+            _, mv = self.__negamax(board_copy, d, -math.inf, math.inf, color, True)
             if mv is not None:
                 best_move = mv
+            self.__collect_pv(board_copy, d)
 
         assert best_move is not None, "No legal move found"
         return best_move
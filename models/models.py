@@ -1,18 +1,33 @@
 from enum import Enum
+from functools import cached_property
 
 from models.ai import AI
 from models.minimax import MiniMax
+from models.uci import UCIEngine
 
 
 class Models(Enum):
     MINIMAX_DEPTH_2 = (MiniMax, (2,))
     MINIMAX_DEPTH_4 = (MiniMax, (4,))
     MINIMAX_DEPTH_6 = (MiniMax, (6,))
+    STOCKFISH_DEPTH_6 = (UCIEngine, (6,))
 
     def __init__(self, ai_cls: AI, init_args: tuple):
-        inst = ai_cls(*init_args)
-        self._value_: AI = inst
+        self.ai_cls = ai_cls
+        self.init_args = init_args
         self.label = f"{ai_cls.__name__}{init_args}"
 
+    @cached_property
+    def instance(self) -> AI:
+        # built on first use, not when the enum is imported
+        return self.ai_cls(*self.init_args)
+
+    @classmethod
+    def close_all(cls):
+        # only the models whose instance was actually built
+        for model in cls:
+            if "instance" in model.__dict__:
+                model.instance.close()
+
     def __str__(self) -> str:
         return self.label
@@ -0,0 +1,74 @@
+import shutil
+from typing import Optional
+
+import chess, chess.engine
+
+from models.ai import AI
+from models.minimax import MiniMax
+
+
+class UCIEngine(AI):
+    """Delegates the search to an external UCI engine (e.g. Stockfish).
+
+    Falls back to the pure Python MiniMax when the engine binary isn't found,
+    or when a restarted engine dies again.
+    """
+
+    def __init__(self, max_depth: int = 6, command: str = "stockfish"):
+        self.max_depth = max_depth
+        self.command = command
+        self._engine: Optional[chess.engine.SimpleEngine] = None
+        self._fallback: Optional[MiniMax] = None
+
+    def __open(self) -> Optional[chess.engine.SimpleEngine]:
+        # started lazily so that listing the models doesn't spawn processes
+        if self._engine is None and self._fallback is None:
+            path = shutil.which(self.command)
+            if path is None:
+                self._fallback = MiniMax(self.max_depth)
+            else:
+                self._engine = chess.engine.SimpleEngine.popen_uci(path)
+        return self._engine
+
+    def close(self):
+        # the engine runs on a non-daemon thread, so this has to be called
+        # explicitly, atexit hooks only run after such threads have finished
+        engine, self._engine = self._engine, None
+        if engine is None:
+            return
+        try:
+            engine.quit()
+        except chess.engine.EngineError:
+            # already dead, just tear down the transport
+            engine.close()
+
+    def stop(self):
+        # a depth limited engine search returns quickly, only the pure
+        # Python fallback needs interrupting
+        if self._fallback is not None:
+            self._fallback.stop()
+
+    def move(self, board: chess.Board) -> chess.Move:
+        engine = self.__open()
+        if engine is None:
+            return self._fallback.move(board)
+
+        limit = chess.engine.Limit(depth=self.max_depth)
+        try:
+            result = engine.play(board, limit)
+        except chess.engine.EngineTerminatedError:
+            # restart the engine once, give up on it if that dies as well
+            self.close()
+            try:
+                engine = self.__open()
+                if engine is not None:
+                    result = engine.play(board, limit)
+            except (chess.engine.EngineError, OSError):
+                self.close()
+                engine = None
+            if engine is None:
+                if self._fallback is None:
+                    self._fallback = MiniMax(self.max_depth)
+                return self._fallback.move(board)
+        assert result.move is not None, "No legal move found"
+        return result.move